@@ -1,10 +1,28 @@
 #!/usr/bin/env python3
 import json
 import os, sys
+import atexit
+import tempfile
+import mmap
+import struct
+import uuid
 import subprocess
 import re
 import datetime
 import argparse
+import collections
+import concurrent.futures
+import functools
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import symbolic
+except ImportError:
+    symbolic = None
 
 # From mac/exception_types.h, as per https://developer.apple.com/documentation/metrickit/mxcrashdiagnostic/3552297-exceptiontype?language=objc
 exceptionTypes = {1: "EXC_BAD_ACCESS",
@@ -54,135 +72,526 @@ signalTypes = {1: "SIGHUP",
                 30: "SIGUSR1",
                 31: "SIGUSR2"}
 
-binaryUuids = {}
-def getDsymUuid(path):
-    global binaryUuids
-    if path not in binaryUuids:
-        uuidResultLine = subprocess.run(["dwarfdump", "--uuid", path], stdout=subprocess.PIPE).stdout.decode("utf-8")
-        dsymUuid = re.search("UUID: ([0-9A-Za-z\-]+?) \(.+", uuidResultLine).group(1)
-        binaryUuids[path] = dsymUuid
-
-    return binaryUuids[path]
-
-
-symbolFiles = {}
-def getSymbolFile(originBinaryName, uuid):
-    startPath = "~/Library/Developer/Xcode/iOS DeviceSupport/"
-    startPath = os.path.expanduser(startPath)
-    global symbolFiles
-
-    key = f"{originBinaryName}.{uuid}"
-    if not key in symbolFiles:
-        # Walk through all the device folders and look for a symbol file for this binary name that matches this UUID
+# From mach-o/loader.h and mach-o/fat.h
+MH_MAGIC = 0xFEEDFACE
+MH_MAGIC_64 = 0xFEEDFACF
+FAT_MAGIC = 0xCAFEBABE
+FAT_MAGIC_64 = 0xCAFEBABF
+LC_UUID = 0x1B
+CPU_TYPE_ARM64 = 0x0100000C
+CPU_SUBTYPE_ARM64E = 2
+CPU_SUBTYPE_MASK = 0xFF000000
+
+# Read the UUID straight out of the LC_UUID load command of a Mach-O file, which is much cheaper than running dwarfdump.
+# For fat files the arm64e slice is used, falling back to any other arm64 slice and then to the first one.
+# Returns None if the file can't be parsed.
+def readMachOUuid(path):
+    try:
+        with open(path, 'rb') as machOFile, mmap.mmap(machOFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            headerOffset = 0
+
+            # Fat headers are always big-endian. The CPU fields are read unsigned, since arm64e subtypes have the high ABI bit set (0x80000002).
+            fatMagic = struct.unpack_from(">I", data, 0)[0]
+            if fatMagic == FAT_MAGIC or fatMagic == FAT_MAGIC_64:
+                archCount = struct.unpack_from(">I", data, 4)[0]
+                sliceOffsets = []
+                for i in range(archCount):
+                    if fatMagic == FAT_MAGIC:
+                        cpuType, cpuSubtype, sliceOffset = struct.unpack_from(">III", data, 8 + i * 20)
+                    else:
+                        cpuType, cpuSubtype, sliceOffset = struct.unpack_from(">IIQ", data, 8 + i * 32)
+                    if cpuType == CPU_TYPE_ARM64:
+                        priority = 0 if (cpuSubtype & ~CPU_SUBTYPE_MASK) == CPU_SUBTYPE_ARM64E else 1
+                    else:
+                        priority = 2
+                    sliceOffsets.append((priority, i, sliceOffset))
+
+                if not sliceOffsets:
+                    return None
+                headerOffset = min(sliceOffsets)[2]
+
+            magic = struct.unpack_from("<I", data, headerOffset)[0]
+            if magic == MH_MAGIC_64:
+                headerSize = 32
+            elif magic == MH_MAGIC:
+                headerSize = 28
+            else:
+                return None
+
+            commandCount = struct.unpack_from("<I", data, headerOffset + 16)[0]
+            commandOffset = headerOffset + headerSize
+            for _ in range(commandCount):
+                cmd, cmdSize = struct.unpack_from("<II", data, commandOffset)
+                if cmd == LC_UUID:
+                    return str(uuid.UUID(bytes=data[commandOffset + 8:commandOffset + 24])).upper()
+                if cmdSize == 0:
+                    return None
+                commandOffset += cmdSize
+    except (OSError, ValueError, struct.error):
+        pass
+
+    return None
+
+# Matches the output of dwarfdump --uuid, which is searched as raw bytes without decoding it
+uuidRegex = re.compile(rb"UUID:\s+([0-9A-Fa-f-]{36})")
+
+# Caches that persist between runs are JSON files in here
+cacheDir = os.path.expanduser("~/.cache/mxsymbolicate/")
+
+def loadCache(fileName):
+    try:
+        with open(cacheDir + fileName, 'r') as cacheFile:
+            return json.load(cacheFile)
+    except (OSError, ValueError):
+        return {}
+
+def saveCache(fileName, data):
+    # Write to a temporary file and rename it over the old one so an interrupted run can't leave a truncated cache behind
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=cacheDir)
+        with os.fdopen(fd, 'w') as cacheFile:
+            json.dump(data, cacheFile)
+        os.replace(tempPath, cacheDir + fileName)
+    except OSError as e:
+        print(f"Couldn't write cache file {fileName}: {e}", file=sys.stderr)
+
+# Read a symbol file's UUID from its Mach-O header, or with dwarfdump if that can't be parsed. Returns None if neither works.
+def readUuid(path):
+    dsymUuid = readMachOUuid(path)
+    if dsymUuid is None:
+        uuidResultLine = subprocess.run(["dwarfdump", "--uuid", path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        match = uuidRegex.search(uuidResultLine)
+        if match:
+            dsymUuid = match.group(1).decode("ascii")
+
+    return dsymUuid
+
+
+deviceSupportPath = os.path.expanduser("~/Library/Developer/Xcode/iOS DeviceSupport/")
+
+# Folders inside <device folder>/Symbols/ that hold libraries directly, like libsystem_kernel.dylib in usr/lib/system.
+# Swift-related symbol files are in their own folder, and some font-related libraries are inside FontServices.framework.
+libraryFolders = ["usr/lib/swift/",
+                    "usr/lib/system/",
+                    "usr/lib/",
+                    "System/Library/PrivateFrameworks/FontServices.framework/"]
+
+# Folders inside <device folder>/Symbols/ that hold bundles like UIKitCore.framework, with the binary inside named after the bundle
+bundleFolders = [("System/Library/Frameworks/", ".framework"),
+                    ("System/Library/PrivateFrameworks/", ".framework"),
+                    ("System/Library/AccessibilityBundles/", ".axbundle"),
+                    ("System/Library/AccessibilityBundles/", ".bundle")]
+
+def scanFolder(path):
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except OSError:
+        return []
+
+# List every symbol file in one device folder. Everything in the list is known to exist.
+def listDeviceSymbolFiles(deviceFolderPath):
+    systemLibPath = deviceFolderPath + "/Symbols/"
+    symbolFilePaths = []
+
+    for folder in libraryFolders:
+        for entry in scanFolder(systemLibPath + folder):
+            if entry.is_file():
+                symbolFilePaths.append(entry.path)
+
+    for folder, extension in bundleFolders:
+        for entry in scanFolder(systemLibPath + folder):
+            # is_dir comes from the directory listing, so this doesn't cost a syscall the way the probes below do
+            if entry.name.endswith(extension) and entry.is_dir():
+                name = entry.name[:-len(extension)]
+                for binaryPath in [f"{entry.path}/{name}", f"{entry.path}/Versions/A/{name}"]:
+                    if os.path.isfile(binaryPath):
+                        symbolFilePaths.append(binaryPath)
+                        break
+
+    return symbolFilePaths
+
+# Device folders are named like "iPhone14,2 17.5 (21F79)", and the OS version in a diagnostic looks like "iPhone OS 17.5 (21F79)".
+# The build number in parentheses is what they have in common.
+osBuildRegex = re.compile(r"\((\w+)\)")
+
+def getOsBuild(osVersion):
+    match = osBuildRegex.search(osVersion)
+    return match.group(1) if match else ""
+
+# The device folders grouped by OS build are cached on disk between runs, along with the mtime (in nanoseconds) of the iOS DeviceSupport folder,
+# which changes whenever a device folder is added or removed.
+deviceIndexCacheFileName = "device_index.json"
+
+deviceFolders = None
+def getDeviceFolders():
+    global deviceFolders
+    if deviceFolders is None:
+        try:
+            mtime = os.stat(deviceSupportPath).st_mtime_ns
+        except OSError:
+            deviceFolders = {}
+            return deviceFolders
+
+        cached = loadCache(deviceIndexCacheFileName)
+        if cached.get("mtime") == mtime:
+            deviceFolders = cached["builds"]
+        else:
+            deviceFolders = {}
+            # is_dir uses the file type from the directory listing for real folders, and only stats symlinks, which are followed
+            # so device folders moved to another disk and linked back in are still found
+            for entry in scanFolder(deviceSupportPath):
+                if entry.is_dir():
+                    deviceFolders.setdefault(getOsBuild(entry.name), []).append(entry.path)
+            saveCache(deviceIndexCacheFileName, {"mtime": mtime, "builds": deviceFolders})
+
+    return deviceFolders
+
+# Each device folder's symbol files are cached on disk between runs by UUID, along with the device folder's mtime (in nanoseconds).
+# Xcode writes marker files into the device folder when it finishes copying symbols, so the mtime changes whenever the contents do.
+symbolIndexCacheFileName = "symbol_index.json"
+
+symbolIndex = {}
+indexedDeviceFolders = set()
+deviceIndexes = None
+
+# Add every symbol file in these device folders to the UUID index, reusing cached indexes of device folders that haven't changed.
+# Reading the UUIDs is a little file I/O per symbol file, so the files in new or changed device folders are read in parallel.
+def indexDeviceFolders(deviceFolderPaths):
+    global deviceIndexes
+    if deviceIndexes is None:
+        deviceIndexes = loadCache(symbolIndexCacheFileName)
+
+    staleDeviceFolders = []
+    for deviceFolderPath in deviceFolderPaths:
+        indexedDeviceFolders.add(deviceFolderPath)
+        try:
+            mtime = os.stat(deviceFolderPath).st_mtime_ns
+        except OSError:
+            continue
+
+        cached = deviceIndexes.get(deviceFolderPath)
+        if not cached or cached["mtime"] != mtime or "uuids" not in cached:
+            staleDeviceFolders.append((deviceFolderPath, mtime, listDeviceSymbolFiles(deviceFolderPath)))
+
+    if staleDeviceFolders:
+        symbolFilePaths = [path for _, _, paths in staleDeviceFolders for path in paths]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            symbolFileUuids = dict(zip(symbolFilePaths, executor.map(readUuid, symbolFilePaths)))
+
+        for deviceFolderPath, mtime, paths in staleDeviceFolders:
+            uuids = {}
+            for path in paths:
+                if symbolFileUuids[path]:
+                    uuids.setdefault(symbolFileUuids[path], path)
+            deviceIndexes[deviceFolderPath] = {"mtime": mtime, "uuids": uuids}
+
+        # Drop device folders that no longer exist while saving
+        allDeviceFolders = set(path for paths in getDeviceFolders().values() for path in paths)
+        saveCache(symbolIndexCacheFileName, {path: deviceIndex for path, deviceIndex in deviceIndexes.items() if path in allDeviceFolders})
+
+    for deviceFolderPath in deviceFolderPaths:
+        if deviceFolderPath in deviceIndexes:
+            for binaryUuid, path in deviceIndexes[deviceFolderPath]["uuids"].items():
+                symbolIndex.setdefault(binaryUuid, path)
+
+# Spotlight indexes dSYM bundles by the UUIDs of the binaries in them, which finds dSYMs outside iOS DeviceSupport, like ones in other xcarchives.
+# Returns the path of the binary inside the first matching dSYM with this UUID, or an empty string if there isn't one or mdfind isn't available.
+@functools.lru_cache(maxsize=None)
+def findSymbolFileWithSpotlight(originUuid):
+    try:
+        mdfindOutput = subprocess.run(["mdfind", f"com_apple_xcode_dsym_uuids == {originUuid}"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8").stdout
+    except OSError:
+        return ""
+
+    for dsymPath in mdfindOutput.splitlines():
+        for entry in scanFolder(dsymPath + "/Contents/Resources/DWARF"):
+            if readUuid(entry.path) == originUuid:
+                return entry.path
+
+    return ""
+
+# The app's binary name, set from the arguments in main
+binaryName = ""
 
-        foundPath = ""
-        for deviceFolder in os.listdir(startPath):
-            systemLibPath = startPath + deviceFolder + "/Symbols/"
-            if not os.path.exists(systemLibPath):
-                continue
+# UUIDs are unique, so the binary name isn't needed to find a symbol file. The app's symbols file is added to the index at startup.
+# App frames can only be symbolicated with that symbols file, so if their UUID doesn't match it the device folders aren't searched for them.
+# Device folders for osBuild, the OS build of the diagnostic the frame is from, are indexed first, and the rest only if the UUID isn't found in them.
+# Spotlight is the last resort, for app frames too.
+def getSymbolFile(originBinaryName, originUuid, osBuild=""):
+    originUuid = originUuid.upper()
+    if originUuid not in symbolIndex and originBinaryName != binaryName:
+        builds = getDeviceFolders()
+        for deviceFolderPaths in [builds.get(osBuild, []), [path for paths in builds.values() for path in paths]]:
+            unindexedPaths = [path for path in deviceFolderPaths if path not in indexedDeviceFolders]
+            if unindexedPaths:
+                indexDeviceFolders(unindexedPaths)
+            if originUuid in symbolIndex:
+                break
 
-            if originBinaryName == binaryName:
-                # If the binary name is the one we specified the symbols path for, use that
-                foundPath = symbolsFilePath
-            elif originBinaryName.startswith("libswift"):
-                # Swift-related symbol files are in their own folder
-                foundPath = systemLibPath + "usr/lib/swift/" + originBinaryName
-            elif originBinaryName.startswith("lib") and originBinaryName.endswith(".dylib"):
-                # A binary name like libsystem_kernel.dylib is going to be in <device folder>/usr/lib/system
-                foundPath = systemLibPath + "usr/lib/system/" + originBinaryName
-                if not os.path.exists(foundPath):
-                    foundPath = systemLibPath + "usr/lib/" + originBinaryName
-
-                if originBinaryName in ["libFontParser.dylib", "libGSFont.dylib", "libGSFontCache.dylib", "libType1Scaler.dylib", "libhvf.dylib"]:
-                    foundPath = systemLibPath + "System/Library/PrivateFrameworks/FontServices.framework/" + originBinaryName
-            elif originBinaryName == "dyld":
-                foundPath = systemLibPath + "usr/lib/dyld"
+    if originUuid not in symbolIndex:
+        dsymPath = findSymbolFileWithSpotlight(originUuid)
+        if dsymPath:
+            symbolIndex[originUuid] = dsymPath
+
+    return symbolIndex.get(originUuid, "")
+
+# All frames are symbolicated for this architecture
+atosArchitecture = "arm64e"
+
+# Symbolicated atos output keyed by (dsymPath, arch, offset), filled in a batch per binary before a call stack tree is printed
+symbolicatedOffsets = {}
+
+def runAtos(dsymPath, arch, offsets):
+    # This is based on this forum post: https://developer.apple.com/forums/thread/681967
+    # --offset makes atos treat every address as an offset into the binary's text segment, so no load address is needed,
+    # and with no addresses on the command line atos reads them from stdin, so one process can handle every offset in this binary.
+    # Output is decoded as it's read rather than decoded from one big bytes buffer afterwards
+    atos = subprocess.Popen(["atos", "-i", "-arch", arch, "-o", dsymPath, "--offset"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8", bufsize=8192)
+    atosOutput, _ = atos.communicate("".join(hex(offset) + "\n" for offset in offsets))
+    atosOutput = atosOutput.strip()
+
+    # Each address gets one line, or with -i a group of lines (one per inlined frame) followed by a blank line
+    if len(offsets) == 1:
+        groups = [atosOutput]
+    elif "\n\n" in atosOutput:
+        groups = atosOutput.split("\n\n")
+    else:
+        groups = atosOutput.splitlines()
+
+    if len(groups) == len(offsets):
+        return [group.strip() for group in groups]
+
+    # The output couldn't be matched up with the addresses, so fall back to one atos run per address
+    results = []
+    for offset in offsets:
+        atosResult = subprocess.run(["atos", "-i", "-arch", arch, "-o", dsymPath, "--offset", hex(offset)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8").stdout
+        results.append(atosResult.strip())
+    return results
+
+# Symbol files are only loaded into a symcache by the symbolic backend once, even if they're used for more than one batch.
+# App dSYMs usually only have an arm64 slice, which is what arm64e devices run, so that's used if there's no slice for arch.
+# Returns None if the file can't be read or has neither slice, so the binary is left to atos.
+@functools.lru_cache(maxsize=None)
+def loadSymCache(dsymPath, arch):
+    try:
+        archive = symbolic.Archive.open(dsymPath)
+        try:
+            symbolObject = archive.get_object(arch=arch)
+        except LookupError:
+            symbolObject = archive.get_object(arch="arm64")
+        return symbolObject.make_symcache()
+    except (LookupError, symbolic.SymbolicError):
+        return None
+
+# symbolic gives symbol names as they are in the symbol file, so they're demangled like atos does with c++filt and then swift-demangle,
+# each run once for all the names. Names are left as they are by a tool that isn't available.
+def demangleSymbols(symbols):
+    for command in [["c++filt"], ["xcrun", "swift-demangle", "--simplified"]]:
+        try:
+            demangled = subprocess.run(command, input="".join(symbol + "\n" for symbol in symbols), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf-8").stdout.splitlines()
+        except OSError:
+            continue
+        if len(demangled) == len(symbols):
+            symbols = demangled
+
+    return symbols
+
+# Look the offsets up in-process with the symbolic package (version 13), formatting the results like atos does.
+# Offsets it can't find anything for, or every offset if it can't read the symbol file, are left to atos.
+def runSymbolic(dsymPath, arch, offsets):
+    symCache = loadSymCache(dsymPath, arch)
+    if symCache is None:
+        return runAtos(dsymPath, arch, offsets)
+
+    # Each lookup gives a SourceLocation per inlined frame, innermost first, just like atos -i
+    offsetLocations = [symCache.lookup(offset) for offset in offsets]
+    symbols = list(set(location.symbol for locations in offsetLocations for location in locations))
+    demangledSymbols = dict(zip(symbols, demangleSymbols(symbols)))
+
+    fileName = os.path.basename(dsymPath)
+    results = []
+    for locations in offsetLocations:
+        lines = []
+        for location in locations:
+            symbol = demangledSymbols[location.symbol]
+            if location.line and location.full_path:
+                lines.append(f"{symbol} (in {fileName}) ({os.path.basename(location.full_path)}:{location.line})")
             else:
-                # Other binary names like Foundation or UIKitCore are going to be either in <device folder>/System/Library/Frameworks or <device folder>/System/Library/PrivateFrameworks
-                foundPath = systemLibPath + "System/Library/Frameworks/{0}.framework/{0}".format(originBinaryName)
+                lines.append(f"{symbol} (in {fileName}) + {location.instr_addr - location.sym_addr}")
+        results.append("\n".join(lines) if lines else None)
+
+    missingOffsets = [offset for offset, result in zip(offsets, results) if result is None]
+    if missingOffsets:
+        atosResults = iter(runAtos(dsymPath, arch, missingOffsets))
+        results = [next(atosResults) if result is None else result for result in results]
+    return results
+
+# Which of the functions above symbolicates offsets, chosen with --backend
+symbolicationBackends = {"atos": runAtos,
+                    "symbolic": runSymbolic}
+symbolicate = runAtos
+
+def hasFrameInformation(frame):
+    return frame.get("offsetIntoBinaryTextSegment") and frame.get("binaryName") and frame.get("binaryUUID")
+
+# The parts of a call stack frame that are used, kept in a tuple rather than the report's dict to use a fraction of the memory in big call stack trees.
+# A frame with missing information has None for its offset and no subframes, since those aren't printed.
+Frame = collections.namedtuple("Frame", ["offset", "binaryName", "binaryUUID", "sampleCount", "subFrames"])
+missingFrame = Frame(None, None, None, 0, ())
+
+# Build the Frame tree for a frame dict from the report. Like walkFrames, this uses an explicit stack rather than recursion.
+# Frames are built after their subframes, which are the last ones in builtFrames when their parent comes off the stack again.
+# Binary names and UUIDs repeat throughout a report, so they're interned to share one string each.
+def projectFrame(root):
+    builtFrames = []
+    stack = [(root, False)]
+    while stack:
+        frame, subFramesBuilt = stack.pop()
+        if not hasFrameInformation(frame):
+            builtFrames.append(missingFrame)
+            continue
+
+        subFrameCount = len(frame.get("subFrames") or ())
+        if subFrameCount and not subFramesBuilt:
+            stack.append((frame, True))
+            stack.extend((sub, False) for sub in reversed(frame["subFrames"]))
+            continue
+
+        subFrames = tuple(builtFrames[len(builtFrames) - subFrameCount:])
+        del builtFrames[len(builtFrames) - subFrameCount:]
+        builtFrames.append(Frame(frame["offsetIntoBinaryTextSegment"], sys.intern(frame["binaryName"]), sys.intern(frame["binaryUUID"]), frame.get("sampleCount", 0), subFrames))
+
+    return builtFrames[0]
+
+# Replace the root frames of these diagnostics' call stacks with Frame trees, so the report's frame dicts can be freed
+def projectDiagnostics(diags):
+    for diag in diags:
+        for stack in diag["callStackTree"]["callStacks"]:
+            stack["callStackRootFrames"] = [projectFrame(root) for root in stack["callStackRootFrames"]]
+
+# Walk a frame and its subframes depth first, in print order, yielding each frame with its level.
+# This uses an explicit stack rather than recursion, so very deep call stacks can't hit the recursion limit.
+def walkFrames(root, level=-1):
+    stack = [(root, level)]
+    while stack:
+        frame, frameLevel = stack.pop()
+        yield frame, frameLevel
+
+        if frame.subFrames:
+            subLevel = frameLevel + 1 if frameLevel >= 0 else frameLevel
+            stack.extend((sub, subLevel) for sub in reversed(frame.subFrames))
+
+# The symbol file found for each binaryUUID, exactly as it's written in the report, so printing a frame doesn't need to normalize its UUID again.
+# Binaries without a symbol file map to an empty string.
+frameSymbolFiles = {}
+
+# Walk the call stack trees of these diagnostics and run atos once per binary for all the offsets in them that haven't been symbolicated yet.
+# Doing this for every diagnostic in a report up front means each binary's dSYM is only loaded by atos once.
+def symbolicateDiagnostics(diags):
+    global symbolicatedOffsets
+
+    # Collect the offsets by binary first, so each binary's symbol file is looked up once rather than once per frame.
+    # Grouping them in a dict does in one pass what sorting the frames by binary would.
+    binaryOffsets = collections.defaultdict(set)
+    for diag in diags:
+        osBuild = getOsBuild(diag["diagnosticMetaData"].get("osVersion", ""))
+        for stack in diag["callStackTree"]["callStacks"]:
+            for root in stack["callStackRootFrames"]:
+                for frame, _ in walkFrames(root):
+                    if frame.offset is not None:
+                        binaryOffsets[(frame.binaryName, frame.binaryUUID, osBuild)].add(frame.offset)
+
+    # Each binary's atos run is independent and spends its time waiting on the subprocess, so they run in parallel.
+    # Each one starts as soon as its symbol file is found, so the first atos runs overlap with indexing device folders for the rest.
+    pendingOffsets = set()
+    batches = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for (originBinaryName, originUuid, osBuild), offsets in binaryOffsets.items():
+            dsymPath = getSymbolFile(originBinaryName, originUuid, osBuild)
+            frameSymbolFiles[originUuid] = dsymPath
+            if len(dsymPath) == 0:
+                continue
 
-                if not os.path.exists(foundPath):
-                    foundPath = systemLibPath + f"System/Library/Frameworks/{originBinaryName}.framework/Versions/A/{originBinaryName}"
+            # Offsets are looked up in address order, so atos moves through the symbol file in one direction
+            batchOffsets = []
+            for offset in sorted(offsets):
+                key = (dsymPath, atosArchitecture, offset)
+                if key not in symbolicatedOffsets and key not in pendingOffsets:
+                    pendingOffsets.add(key)
+                    batchOffsets.append(offset)
 
-                if not os.path.exists(foundPath):
-                    foundPath = systemLibPath + "System/Library/PrivateFrameworks/{0}.framework/{0}".format(originBinaryName)
-                
-                if not os.path.exists(foundPath):
-                    foundPath = systemLibPath + f"System/Library/AccessibilityBundles/{originBinaryName}.axbundle/{originBinaryName}"
+            if batchOffsets:
+                batches.append((dsymPath, batchOffsets, executor.submit(symbolicate, dsymPath, atosArchitecture, batchOffsets)))
 
-                if not os.path.exists(foundPath):
-                    foundPath = systemLibPath + f"System/Library/AccessibilityBundles/{originBinaryName}.bundle/{originBinaryName}"
+        for dsymPath, batchOffsets, batch in batches:
+            for offset, atosResult in zip(batchOffsets, batch.result()):
+                symbolicatedOffsets[(dsymPath, atosArchitecture, offset)] = atosResult.replace("\n", " <newline> ")
 
-            if len(foundPath) > 0 and os.path.exists(foundPath) and getDsymUuid(foundPath) == uuid:
-                symbolFiles[key] = foundPath
-                break
-
-        if key not in symbolFiles:
-            symbolFiles[key] = ""
+# Output lines are collected here and written to stdout in one go after each call stack, then to the output file at the end
+resultLines = []
+def printResultLine(ln):
+    resultLines.append(ln + "\n")
 
-    return symbolFiles[key]
+printedLineCount = 0
+def flushResultLines():
+    global printedLineCount
+    sys.stdout.write("".join(resultLines[printedLineCount:]))
+    sys.stdout.flush()
+    printedLineCount = len(resultLines)
 
-result = ""
-def printResultLine(ln):
-    global result
-    result += ln + "\n"
-    print(ln)
+# Indentation for spindump-style call stacks, built once for all but the very deepest levels
+spacer = "|  "
+indentPrefixes = tuple(spacer * level for level in range(1024))
 
-# Pass 0 for level to format the call stack as indented like a spindump, or -1 to print like a crash stack
+# Pass 0 for level to format the call stack as indented like a spindump, or -1 to print like a crash stack.
+# This walks the frames with its own explicit stack rather than using walkFrames, since it runs for every frame that's printed.
 def printFrame(root, level=-1):
-    offset = root["offsetIntoBinaryTextSegment"] if "offsetIntoBinaryTextSegment" in root else None
-    originBinaryName = root["binaryName"] if "binaryName" in root else None
-    originUuid = root["binaryUUID"] if "binaryUUID" in root else None
-    sampleCount = 0
-    if "sampleCount" in root:
-        sampleCount = root["sampleCount"]
-
-    spacer = "|  "
-    indentPrefix = spacer * level if level >= 0 else ""
-
-    if not offset or not originBinaryName or not originUuid:
-        printResultLine(f"{indentPrefix}<missing information in frame>")
-        return
-
-    dsymPath = getSymbolFile(originBinaryName, originUuid)
-    
-    processedLine = False
-    errorReason = ""
-    
-    if len(dsymPath) > 0:
-        # This is based on this forum post: https://developer.apple.com/forums/thread/681967
-        atosResult = subprocess.run(["atos", "-i", "-arch", "arm64e", "-o", dsymPath, "--offset", hex(offset)], stdout=subprocess.PIPE).stdout.decode("utf-8")
-        atosResult = atosResult.strip().replace("\n", " <newline> ")
-        if level >= 0:
-            # This is a cpu or disk write diagnostic. Print it sort of like how spindumps are formatted.
-            printResultLine("{0}{1}: {2}".format(indentPrefix, sampleCount, atosResult))
+    # Lines are appended directly rather than through printResultLine, since this is the hot path
+    addLine = resultLines.append
+    stack = [(root, level)]
+    while stack:
+        frame, frameLevel = stack.pop()
+        indentPrefix = indentPrefixes[frameLevel] if 0 <= frameLevel < len(indentPrefixes) else spacer * max(frameLevel, 0)
+
+        offset = frame.offset
+        if offset is None:
+            addLine(f"{indentPrefix}<missing information in frame>\n")
+            continue
+
+        originBinaryName = frame.binaryName
+        sampleCount = frame.sampleCount
+
+        # symbolicateDiagnostics has already looked for the symbol file for every frame's UUID
+        dsymPath = frameSymbolFiles[frame.binaryUUID]
+
+        if len(dsymPath) > 0:
+            atosResult = symbolicatedOffsets[(dsymPath, atosArchitecture, offset)]
+            if frameLevel >= 0:
+                # This is a cpu or disk write diagnostic. Print it sort of like how spindumps are formatted.
+                addLine(f"{indentPrefix}{sampleCount}: {atosResult}\n")
+            else:
+                # Crash diagnostic or otherwise
+                addLine(atosResult + "\n")
         else:
-            # Crash diagnostic or otherwise
-            printResultLine(atosResult)
-        processedLine = True
-    else:
-        errorReason = "symbols not found"
+            addLine(f"{indentPrefix}<WARNING, symbols not found> {originBinaryName} ({offset})\n")
 
-    if processedLine == False:
-        printResultLine(f"{indentPrefix}<WARNING, {errorReason}> {originBinaryName} ({offset})")
+        # Push the subframes in reverse so they're popped, and printed, in their original order
+        if frame.subFrames:
+            subLevel = frameLevel + 1 if frameLevel >= 0 else frameLevel
+            for sub in reversed(frame.subFrames):
+                stack.append((sub, subLevel))
 
-    if "subFrames" in root:
-        frames = root["subFrames"]
-        if level >= 0:
-            level = level + 1
-        for sub in frames:
-            printFrame(sub, level=level)
 
-
-forceHierarchical = False
-def printCallstack(callstackTree):
+# Pass True for forceHierarchical to print the call stack like a spindump whatever its callStackPerThread property says
+def printCallstack(callstackTree, forceHierarchical=False):
     index = 0
 
     # The callStackPerThread property indicates whether each object in callStackRootFrames can be relied on to have one linear call stack.
     # When this property is false, it means this is a report like a spindump, where it's going to show multiple stacks at a time with sample counts.
     # In that case we format it like a spindump, with each line indented further than the last one, to make the hierarchy clear.
-    simpleCallStack = callstackTree["callStackPerThread"] if "callStackPerThread" in callstackTree else False
-    global forceHierarchical
+    simpleCallStack = callstackTree.get("callStackPerThread", False)
     if forceHierarchical:
         simpleCallStack = False
 
@@ -190,12 +599,14 @@ def printCallstack(callstackTree):
         rootFrames = stack["callStackRootFrames"]
 
         # The threadAttributed property indicates whether this is the thread that is "attributed" (crashed in a crash diagnostic)
-        crashed = stack["threadAttributed"] if "threadAttributed" in stack else False
+        crashed = stack.get("threadAttributed", False)
 
         for root in rootFrames:
-            printResultLine('{0}Call stack {1}:'.format("Attributed: " if crashed else "", index))
+            attributedPrefix = "Attributed: " if crashed else ""
+            printResultLine(f"{attributedPrefix}Call stack {index}:")
             printFrame(root, level=-1 if simpleCallStack else 0)
             printResultLine("")
+            flushResultLines()
             index += 1
 
 def processCrashDiagnostic(diag):
@@ -208,20 +619,16 @@ def processCrashDiagnostic(diag):
     excCode = meta["exceptionCode"]
     signal = meta["signal"]
 
-    printResultLine("Symbolicating crash report from {0} {1}.{2}".format(bundleId, appVersion, appBuildVersion))
+    printResultLine(f"Symbolicating crash report from {bundleId} {appVersion}.{appBuildVersion}")
 
-    exceptionTypeName = "unknown"
-    if excType in exceptionTypes:
-        exceptionTypeName = exceptionTypes[excType]
+    exceptionTypeName = exceptionTypes.get(excType, "unknown")
 
-    printResultLine("Exception type: {0}, {1}".format(excType, exceptionTypeName))
-    printResultLine("Exception code: {0}".format(excCode))
+    printResultLine(f"Exception type: {excType}, {exceptionTypeName}")
+    printResultLine(f"Exception code: {excCode}")
 
-    signalName = "unknown"
-    if signal in signalTypes:
-        signalName = signalTypes[signal]
+    signalName = signalTypes.get(signal, "unknown")
 
-    printResultLine("Signal: {0}, {1}".format(signal, signalName))
+    printResultLine(f"Signal: {signal}, {signalName}")
     printResultLine("")
 
     callstackTree = diag["callStackTree"]
@@ -235,8 +642,8 @@ def processDiskDiagnostic(diag):
     osVersion = meta["osVersion"]
     writes = meta["writesCaused"]
 
-    printResultLine("Symbolicating disk write exception diagnostic from {0} {1}.{2}".format(bundleId, appVersion, appBuildVersion))
-    printResultLine("Writes caused: {0}".format(writes))
+    printResultLine(f"Symbolicating disk write exception diagnostic from {bundleId} {appVersion}.{appBuildVersion}")
+    printResultLine(f"Writes caused: {writes}")
     printResultLine("")
 
     callStack = diag["callStackTree"]
@@ -251,8 +658,8 @@ def processCpuDiagnostic(diag):
     totalTime = meta["totalCPUTime"]
     sampledTime = meta["totalSampledTime"]
 
-    printResultLine("Symbolicating CPU exception diagnostic from {0} {1}.{2}".format(bundleId, appVersion, appBuildVersion))
-    printResultLine("Total time: {0} of {1}".format(totalTime, sampledTime))
+    printResultLine(f"Symbolicating CPU exception diagnostic from {bundleId} {appVersion}.{appBuildVersion}")
+    printResultLine(f"Total time: {totalTime} of {sampledTime}")
     printResultLine("")
 
     callStack = diag["callStackTree"]
@@ -266,99 +673,158 @@ def processAppLaunchDiagnostic(diag):
     osVersion = meta["osVersion"]
     duration = meta["launchDuration"]
 
-    #App launch diagnostics should be formatted like spindumps, but the callStackPerThread value is true, seemingly wrongly
-    global forceHierarchical
-    forceHierarchical = True
-
-    printResultLine("Symbolicating app launch diagnostic from {0} {1}.{2}".format(bundleId, appVersion, appBuildVersion))
+    printResultLine(f"Symbolicating app launch diagnostic from {bundleId} {appVersion}.{appBuildVersion}")
     printResultLine(f"Launch duration: {duration}")
     printResultLine("")
 
+    #App launch diagnostics should be formatted like spindumps, but the callStackPerThread value is true, seemingly wrongly
     callStack = diag["callStackTree"]
-    printCallstack(callStack)
-
-
-
+    printCallstack(callStack, forceHierarchical=True)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--report-path", help="Path to MetricKit diagnostic report")
-parser.add_argument("--symbols-path", help="Path to symbols file, either xcarchive or dSYM")
-parser.add_argument("--binary-name", help="Binary name. Pulled from the file name of the symbols path if not specified.")
+# The properties the Olive Tree Bible App adds to the root object alongside the payload
+reportInfoKeys = ["customer_id", "timestamp", "os_version", "device_model", "app_version"]
 
-args = parser.parse_args()
-
-if not args.report_path or not args.symbols_path:
-    printResultLine("Report path and symbols path are required.")
-    exit(1)
-
-jsonPath = args.report_path
-symbolsFilePath = args.symbols_path
-
-printResultLine(f"Processing input file: {jsonPath}")
-
-binaryName = ""
-if args.binary_name:
-    binaryName = args.binary_name
-else:
-    symbolFileName = symbolsFilePath.split("/")[-1]
-    binaryName = symbolFileName.split(".")[0]
+def processReportInfo(reportInfo):
+    custId = reportInfo.get("customer_id")
+    timestamp = reportInfo.get("timestamp")
+    osVersion = reportInfo.get("os_version")
+    deviceType = reportInfo.get("device_model")
+    appVersion = reportInfo.get("app_version")
 
-if symbolsFilePath.endswith(".xcarchive"):
-    symbolsFilePath = "{0}/dSYMs/{1}.app.dSYM/Contents/Resources/DWARF/{1}".format(symbolsFilePath, binaryName)
-    
-printResultLine("Binary name: {0}".format(binaryName))
+    if custId and timestamp and osVersion and deviceType and appVersion:
+        reportDate = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
 
-if not os.path.exists(symbolsFilePath):
-    printResultLine("Symbols file path '{0}' does not exist".format(symbolsFilePath))
-    exit(0)
+        printResultLine(f"Customer ID: {custId}")
+        printResultLine(f"Date of report on device: {reportDate}")
+        printResultLine(f"Device: {deviceType}, {osVersion}")
+        printResultLine(f"App version: {appVersion}")
+        printResultLine("")
 
-printResultLine("UUID of specified symbols file is {0}".format(getDsymUuid(symbolsFilePath)))
+# The kinds of diagnostics in a payload, in the order they're processed
+diagnosticProcessors = {"crashDiagnostics": processCrashDiagnostic,
+                        "diskWriteExceptionDiagnostics": processDiskDiagnostic,
+                        "cpuExceptionDiagnostics": processCpuDiagnostic,
+                        "appLaunchDiagnostics": processAppLaunchDiagnostic}
+
+# The diagnostics need to have been through symbolicateDiagnostics first
+def processDiagnostics(diagnosticType, diags):
+    if diagnosticType == "crashDiagnostics" and len(diags) != 1:
+        printResultLine("More than one crashDiagnostics entry!")
+
+    for diag in diags:
+        diagnosticProcessors[diagnosticType](diag)
+
+# orjson is several times faster than json for reports with big call stack trees, so use it if it's installed.
+# It's imported here rather than at the top since --stream runs don't need it.
+def loadReport(jsonFile):
+    try:
+        import orjson
+    except ImportError:
+        return json.load(jsonFile)
+
+    return orjson.loads(jsonFile.read())
+
+# Process the report without loading all of it into memory at once, in a single pass of the parser.
+# The root properties are picked out of the parser events, and each list of diagnostics is built from them and converted to Frame trees as soon as it ends.
+# Nothing is printed until the whole report has been read, since the root properties can come after the payload.
+def processReportStreaming(jsonFile):
+    reportInfo = {}
+    payload = []
+    builder = None
+    for prefix, event, value in ijson.parse(jsonFile, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == builderPrefix and event == "end_array":
+                diags = builder.value
+                projectDiagnostics(diags)
+                payload.append((diagnosticType, diags))
+                builder = None
+        elif event == "start_array" and prefix.startswith("payload.") and prefix[len("payload."):] in diagnosticProcessors:
+            diagnosticType = prefix[len("payload."):]
+            builderPrefix = prefix
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix in reportInfoKeys and event not in ["start_map", "start_array", "end_map", "end_array", "map_key"]:
+            reportInfo[prefix] = value
+
+    processReportInfo(reportInfo)
+
+    symbolicateDiagnostics([diag for _, diags in payload for diag in diags])
+    for diagnosticType, diags in payload:
+        processDiagnostics(diagnosticType, diags)
+
+
+def main():
+    global binaryName, symbolicate
+
+    # Make sure no output is lost if the script exits early
+    atexit.register(flushResultLines)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--report-path", required=True, help="Path to MetricKit diagnostic report")
+    parser.add_argument("--symbols-path", required=True, help="Path to symbols file, either xcarchive or dSYM")
+    parser.add_argument("--binary-name", help="Binary name. Pulled from the file name of the symbols path if not specified.")
+    parser.add_argument("--stream", action="store_true", help="Parse the report incrementally with ijson instead of loading it all at once, for very large reports.")
+    parser.add_argument("--backend", choices=symbolicationBackends.keys(), default="atos", help="How to symbolicate offsets: with atos (the default), or in-process with the symbolic package, falling back to atos.")
+
+    args = parser.parse_args()
+
+    if args.stream and ijson is None:
+        printResultLine("The --stream option requires the ijson package.")
+        sys.exit(1)
+
+    if args.backend == "symbolic" and (symbolic is None or not hasattr(symbolic, "SourceLocation")):
+        printResultLine("The symbolic backend requires version 13 of the symbolic package.")
+        sys.exit(1)
+
+    symbolicate = symbolicationBackends[args.backend]
+
+    jsonPath = args.report_path
+    symbolsFilePath = args.symbols_path
+
+    printResultLine(f"Processing input file: {jsonPath}")
+
+    if args.binary_name:
+        binaryName = args.binary_name
+    else:
+        binaryName = os.path.basename(symbolsFilePath).partition(".")[0]
 
-with open(jsonPath, 'r') as jsonFile:
-    jsonData = json.loads(jsonFile.read())
+    if symbolsFilePath.endswith(".xcarchive"):
+        symbolsFilePath = f"{symbolsFilePath}/dSYMs/{binaryName}.app.dSYM/Contents/Resources/DWARF/{binaryName}"
 
-    custId = jsonData.get("customer_id")
-    timestamp = jsonData.get("timestamp")
-    osVersion = jsonData.get("os_version")
-    deviceType = jsonData.get("device_model")
-    appVersion = jsonData.get("app_version")
+    printResultLine(f"Binary name: {binaryName}")
 
-    if custId and timestamp and osVersion and deviceType and appVersion:
-        reportDate = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+    if not os.path.exists(symbolsFilePath):
+        printResultLine(f"Symbols file path '{symbolsFilePath}' does not exist")
+        sys.exit(2)
 
-        printResultLine("Customer ID: {0}".format(custId))
-        printResultLine("Date of report on device: {0}".format(reportDate))
-        printResultLine("Device: {0}, {1}".format(deviceType, osVersion))
-        printResultLine(f"App version: {appVersion}")
-        printResultLine("")
+    symbolsFileUuid = readUuid(symbolsFilePath)
+    printResultLine(f"UUID of specified symbols file is {symbolsFileUuid}")
+    if symbolsFileUuid:
+        symbolIndex[symbolsFileUuid.upper()] = symbolsFilePath
 
-    payload = jsonData["payload"]
-
-    if "crashDiagnostics" in payload:
-        crashDiags = payload["crashDiagnostics"]
-        if len(crashDiags) != 1:
-            printResultLine("More than one crashDiagnostics entry!")
-        for diag in crashDiags:
-            processCrashDiagnostic(diag)
-
-    if "diskWriteExceptionDiagnostics" in payload:
-        diskDiags = payload["diskWriteExceptionDiagnostics"]
-        for diag in diskDiags:
-            processDiskDiagnostic(diag)
-
-    if "cpuExceptionDiagnostics" in payload:
-        cpuDiags = payload["cpuExceptionDiagnostics"]
-        for diag in cpuDiags:
-            processCpuDiagnostic(diag)
-
-    if "appLaunchDiagnostics" in payload:
-        launchDiags = payload["appLaunchDiagnostics"]
-        for diag in launchDiags:
-            processAppLaunchDiagnostic(diag)
-    
-    inputFileName = jsonPath.split('/')[-1]
-    outputFileName = inputFileName.replace(".json", "_processed.txt")
-    outputPath = jsonPath.replace(inputFileName, outputFileName)
-    print(f"Writing output to {outputPath}")
-    with open(outputPath, 'w') as outputFile:
-        outputFile.write(result)
+    with open(jsonPath, 'rb') as jsonFile:
+        if args.stream:
+            processReportStreaming(jsonFile)
+        else:
+            jsonData = loadReport(jsonFile)
+            processReportInfo(jsonData)
+
+            payload = jsonData["payload"]
+            diags = [diag for diagnosticType in diagnosticProcessors for diag in payload.get(diagnosticType, [])]
+            projectDiagnostics(diags)
+            symbolicateDiagnostics(diags)
+            for diagnosticType in diagnosticProcessors:
+                if diagnosticType in payload:
+                    processDiagnostics(diagnosticType, payload[diagnosticType])
+
+        inputFileName = jsonPath.split('/')[-1]
+        outputFileName = inputFileName.replace(".json", "_processed.txt")
+        outputPath = jsonPath.replace(inputFileName, outputFileName)
+        flushResultLines()
+        print(f"Writing output to {outputPath}")
+        with open(outputPath, 'w') as outputFile:
+            outputFile.writelines(resultLines)
+
+if __name__ == "__main__":
+    main()